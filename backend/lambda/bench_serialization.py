@@ -0,0 +1,67 @@
+"""
+Benchmark response serialization for getAllAttendance-sized payloads.
+
+Compares the old json.dumps(default=str) path against the shared dumps()
+helper (orjson when installed) and reports raw vs gzip payload sizes.
+
+Usage:
+    python bench_serialization.py [record_count] [repeat]
+"""
+import sys
+import json
+import gzip
+import time
+import uuid
+from decimal import Decimal
+
+from lambda_function import dumps, orjson
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        records.append({
+            'attendance_id': str(uuid.uuid4()),
+            'student_id': str(6522781700 + i % 300),
+            'session_id': str(uuid.uuid4()),
+            'timestamp': '2025-11-18T09:%02d:%02d+07:00' % (i % 60, i % 60),
+            'status': 'Present' if i % 7 else 'Late',
+            'rssi': Decimal(-60 - i % 20),
+            'distance': Decimal('1.25'),
+            'class_id': 'CSS%03d' % (i % 40),
+            'class_name': 'Cloud Computing',
+            'room_id': 'BKD-%d' % (3500 + i % 12),
+            'session_start_time': '2025-11-18T09:00:00+07:00',
+            'teacher_id': 'T%03d' % (i % 25)
+        })
+    return {"attendance": records}
+
+
+def timed(fn, payload, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(payload)
+    return (time.perf_counter() - start) / repeat * 1000, out
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = make_records(count)
+
+    candidates = [
+        ('json.dumps(default=str)', lambda p: json.dumps(p, default=str)),
+        ('dumps() [%s]' % ('orjson' if orjson else 'json'), dumps),
+    ]
+
+    print(f"{count} records, {repeat} runs each")
+    print(f"{'encoder':<28}{'encode ms':>12}{'raw bytes':>14}{'gzip bytes':>14}{'gzip ms':>10}")
+    for name, fn in candidates:
+        encode_ms, body = timed(fn, payload, repeat)
+        raw = body.encode('utf-8')
+        gzip_ms, compressed = timed(lambda b: gzip.compress(b, compresslevel=5), raw, repeat)
+        print(f"{name:<28}{encode_ms:>12.2f}{len(raw):>14}{len(compressed):>14}{gzip_ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,111 @@
 import os
+import re
 import uuid
 import json
+import gzip
+import time
+import base64
+import random
+import hashlib
+from collections import OrderedDict, deque
+from decimal import Decimal
 from datetime import datetime, timedelta, timezone
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.config import Config
+
+# orjson is optional - used for faster encoding when it is bundled with the deployment
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # DynamoDB resource
 dynamodb = boto3.resource('dynamodb', region_name=os.getenv('AWS_REGION', 'us-east-1'))
 
+# Low-retry resource for calls made through call_with_retry, which owns the backoff and
+# time budget there. Everything else keeps the SDK's default retries.
+dynamodb_retry = boto3.resource(
+    'dynamodb',
+    region_name=os.getenv('AWS_REGION', 'us-east-1'),
+    config=Config(retries={'mode': 'standard', 'max_attempts': 2})
+)
+
 USERS_TABLE = os.getenv('USERS_TABLE', 'Users')
 SESSIONS_TABLE = os.getenv('SESSIONS_TABLE', 'Sessions')
 ATTENDANCE_TABLE = os.getenv('ATTENDANCE_TABLE', 'AttendanceRecords')
+IDEMPOTENCY_TABLE = os.getenv('IDEMPOTENCY_TABLE', 'IdempotencyKeys')
 
 users_table = dynamodb.Table(USERS_TABLE)
 sessions_table = dynamodb.Table(SESSIONS_TABLE)
 attendance_table = dynamodb.Table(ATTENDANCE_TABLE)
+
+# Table handles for call_with_retry call sites only
+retry_sessions_table = dynamodb_retry.Table(SESSIONS_TABLE)
+retry_attendance_table = dynamodb_retry.Table(ATTENDANCE_TABLE)
+idempotency_table = dynamodb_retry.Table(IDEMPOTENCY_TABLE)
 THAI_TZ = timezone(timedelta(hours=7))
 
+# Retry policy for DynamoDB throttling
+THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException'
+)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 1.0
+# Time kept in reserve so we can still answer before the Lambda times out
+RETRY_SAFETY_MARGIN_MS = 1000
+
+# Load shedding: after SHED_THRESHOLD throttles within SHED_WINDOW_SECONDS, answer 429 straight away
+SHED_THRESHOLD = int(os.getenv('SHED_THRESHOLD', '20'))
+SHED_WINDOW_SECONDS = int(os.getenv('SHED_WINDOW_SECONDS', '10'))
+SHED_RETRY_AFTER_MAX = 5
+SHEDDABLE_ACTIONS = (
+    'markAttendance', 'getSessionByUUID', 'getActiveSession', 'getAttendanceBySession',
+    'getAttendanceByStudent', 'getAllSessions', 'getAllAttendance', 'getUsers'
+)
+_recent_throttles = deque()
+
+# Gzip is opt-in: a REST API only decodes isBase64Encoded bodies when a binary
+# media type (e.g. */*) is configured, otherwise clients get undecodable base64
+GZIP_ENABLED = os.getenv('GZIP_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = int(os.getenv('GZIP_MIN_BYTES', '1024'))
+
+# Mutating actions whose responses are replayed for a repeated Idempotency-Key
+IDEMPOTENT_ACTIONS = ('markAttendance', 'createSession', 'closeSession')
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+# How long an in-progress claim blocks retries; should exceed the function timeout
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_CACHE_SIZE = 512
+# Retry-After hint while another attempt with the same key is still running
+IDEMPOTENCY_RETRY_AFTER = 2
+
+# Warm-container cache of completed responses: key -> (expires_at, fingerprint, result)
+_idempotency_cache = OrderedDict()
+
+# Warm-container LRU cache of public user profiles: student_id -> (expires_at, user)
+USER_CACHE_TTL_SECONDS = int(os.getenv('USER_CACHE_TTL_SECONDS', '300'))
+USER_CACHE_SIZE = 2048
+BATCH_GET_LIMIT = 100
+MAX_BATCH_USER_IDS = 1000
+_user_cache = OrderedDict()
+
+# Attributes that must never leave the API, even if explicitly requested
+PRIVATE_USER_FIELDS = ('password',)
+
+FIELD_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,Idempotency-Key',
+    'Access-Control-Expose-Headers': 'Retry-After,Idempotent-Replayed',
+    'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
+}
+
 # -------------------------
 # Helper functions
 # -------------------------
@@ -31,18 +120,199 @@ def parse_body(event):
         return body
     return {}
 
+def json_default(obj):
+    """Convert DynamoDB types (Decimal, sets) into JSON-friendly values"""
+    if isinstance(obj, Decimal):
+        # Whole numbers stay ints so ids/counts don't turn into 1.0
+        if obj == obj.to_integral_value():
+            return int(obj)
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj):
+    """Serialize to a JSON string, using orjson when it is available"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=json_default).decode('utf-8')
+        except TypeError:
+            # orjson rejects ints beyond 64 bits, but DynamoDB numbers can have 38 digits
+            pass
+    return json.dumps(obj, default=json_default, separators=(',', ':'))
+
+def get_header(event, name):
+    # API Gateway keeps the client's header casing, so compare case-insensitively
+    headers = event.get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def _quality(params):
+    """Read q= from an Accept-Encoding entry's parameters, in any position"""
+    for param in params:
+        name, _, value = param.strip().partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value.strip())
+            except ValueError:
+                return 0.0
+    return 1.0
+
+def accepts_gzip(event):
+    accept = get_header(event, 'Accept-Encoding') or ''
+    qualities = {}
+    for part in accept.split(','):
+        token, *params = part.split(';')
+        token = token.strip().lower()
+        if token in ('gzip', '*'):
+            qualities[token] = _quality(params)
+    # An explicit gzip entry wins over the * wildcard
+    if 'gzip' in qualities:
+        return qualities['gzip'] > 0
+    return qualities.get('*', 0) > 0
+
 def response(status=200, body=None):
+    headers = {**CORS_HEADERS, 'Content-Type': 'application/json'}
+    if GZIP_ENABLED:
+        # Caches must key on Accept-Encoding even for responses that skip compress_response
+        headers['Vary'] = 'Accept-Encoding'
     return {
         'statusCode': status,
-        'headers': {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS',
-            'Content-Type': 'application/json'
-        },
-        'body': json.dumps(body or {})
+        'headers': headers,
+        'body': dumps(body or {})
+    }
+
+def parse_fields(event, params):
+    """Read the optional `fields` parameter as a list of attribute names"""
+    raw = params.get('fields') or (event.get('queryStringParameters') or {}).get('fields')
+    if not raw:
+        return None
+    if isinstance(raw, str):
+        raw = raw.split(',')
+    if not isinstance(raw, list):
+        raise ValueError("fields must be a list or comma-separated string")
+    fields = []
+    for name in raw:
+        name = str(name).strip()
+        if not name:
+            continue
+        if not FIELD_NAME_RE.match(name):
+            raise ValueError(f"invalid field name {name}")
+        if name not in fields:
+            fields.append(name)
+    return fields or None
+
+def projection_kwargs(fields, *required):
+    """Build ProjectionExpression kwargs; `required` attributes are always fetched"""
+    if not fields:
+        return {}
+    names = list(dict.fromkeys([*fields, *required]))
+    # Placeholders avoid clashes with reserved words such as status and timestamp
+    return {
+        'ProjectionExpression': ', '.join(f'#p{i}' for i in range(len(names))),
+        'ExpressionAttributeNames': {f'#p{i}': name for i, name in enumerate(names)}
+    }
+
+def trim_item(item, fields):
+    if not fields:
+        return item
+    return {k: item[k] for k in fields if k in item}
+
+def compress_response(result, event):
+    """Gzip large bodies when enabled and the client sent Accept-Encoding: gzip"""
+    if not GZIP_ENABLED:
+        return result
+    # The response depends on Accept-Encoding whether or not this one gets compressed
+    headers = {**result.get('headers', {}), 'Vary': 'Accept-Encoding'}
+    body = result.get('body')
+    if not isinstance(body, str) or not accepts_gzip(event):
+        return {**result, 'headers': headers}
+    raw = body.encode('utf-8')
+    if len(raw) < GZIP_MIN_BYTES:
+        return {**result, 'headers': headers}
+    return {
+        **result,
+        'headers': {**headers, 'Content-Encoding': 'gzip'},
+        'body': base64.b64encode(gzip.compress(raw, compresslevel=5)).decode('ascii'),
+        'isBase64Encoded': True
     }
 
+class ThrottledError(Exception):
+    """DynamoDB kept throttling and the retry budget ran out"""
+    def __init__(self, message="service is busy, please retry", retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_throttling_error(e):
+    code = (getattr(e, 'response', None) or {}).get('Error', {}).get('Code')
+    return code in THROTTLING_ERROR_CODES
+
+def record_throttle():
+    _recent_throttles.append(time.time())
+
+def should_shed_load():
+    cutoff = time.time() - SHED_WINDOW_SECONDS
+    while _recent_throttles and _recent_throttles[0] < cutoff:
+        _recent_throttles.popleft()
+    return len(_recent_throttles) >= SHED_THRESHOLD
+
+def backoff_delay(attempt):
+    # Full jitter so a burst of clients doesn't retry in lockstep
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def remaining_ms(context):
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis() - RETRY_SAFETY_MARGIN_MS
+    return None
+
+def wait_before_retry(attempt, context, reason):
+    """
+    Record a throttle, then sleep before retry `attempt` - or raise ThrottledError
+    when attempts or the remaining invocation time run out.
+    """
+    record_throttle()
+    delay = backoff_delay(attempt)
+    budget = remaining_ms(context)
+    if attempt >= RETRY_MAX_ATTEMPTS or (budget is not None and delay * 1000 > budget):
+        print(f"Giving up after {attempt} throttled attempts: {reason}")
+        raise ThrottledError(retry_after=random.randint(1, SHED_RETRY_AFTER_MAX))
+    time.sleep(delay)
+
+def call_with_retry(fn, *args, context=None, **kwargs):
+    """
+    Call a DynamoDB operation, retrying throttling errors with jittered backoff.
+    Other errors are raised immediately. Raises ThrottledError when attempts or
+    the remaining invocation time run out.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            attempt += 1
+            wait_before_retry(attempt, context, e)
+
+def retry_after_response(status, error, retry_after):
+    result = response(status, {"error": error, "retry_after": retry_after})
+    result['headers']['Retry-After'] = str(retry_after)
+    return result
+
+def raise_if_throttled(e):
+    """Turn a throttling error into ThrottledError so callers don't fall back to heavier reads"""
+    if is_throttling_error(e):
+        record_throttle()
+        raise ThrottledError(retry_after=random.randint(1, SHED_RETRY_AFTER_MAX)) from e
+
+def throttled_response(retry_after):
+    return retry_after_response(429, "service is busy, please retry", retry_after)
+
 # -------------------------
 # 1) Create User
 # -------------------------
@@ -67,7 +337,9 @@ def createUser(event, context=None):
         item['password'] = body['password']  # In production, hash this!
     
     users_table.put_item(Item=item)
-    return response(200, {"message": "user created", "user": item})
+    _user_cache.pop(item['student_id'], None)
+    public_user = {k: v for k, v in item.items() if k not in PRIVATE_USER_FIELDS}
+    return response(200, {"message": "user created", "user": public_user})
 
 # -------------------------
 # 2) Get User
@@ -77,11 +349,87 @@ def getUser(event, context=None):
     student_id = body.get('student_id') or (event.get('pathParameters') or {}).get('student_id')
     if not student_id:
         return response(400, {"error": "missing student_id"})
-    resp = users_table.get_item(Key={'student_id': student_id})
+    try:
+        fields = parse_fields(event, body)
+    except ValueError as e:
+        return response(400, {"error": str(e)})
+    if fields:
+        fields = [f for f in fields if f not in PRIVATE_USER_FIELDS] or ['student_id']
+    resp = users_table.get_item(Key={'student_id': student_id}, **projection_kwargs(fields))
     item = resp.get('Item')
     if not item:
         return response(404, {"error": "user not found"})
-    return response(200, {"user": item})
+    user = {k: v for k, v in item.items() if k not in PRIVATE_USER_FIELDS}
+    return response(200, {"user": user})
+
+# -------------------------
+# 2.2) Get Users (batch)
+# -------------------------
+def fetch_users(student_ids, context=None):
+    """
+    Look up many users at once, serving repeats from the container cache.
+    Returns {student_id: public user} for the ids that exist.
+    Raises ThrottledError if DynamoDB keeps leaving keys unprocessed.
+    """
+    now = time.time()
+    found = {}
+    missing = []
+    for student_id in dict.fromkeys(student_ids):
+        cached = _user_cache.get(student_id)
+        if cached and cached[0] > now:
+            _user_cache.move_to_end(student_id)
+            found[student_id] = cached[1]
+        else:
+            missing.append(student_id)
+    
+    for start in range(0, len(missing), BATCH_GET_LIMIT):
+        request = {USERS_TABLE: {'Keys': [{'student_id': sid} for sid in missing[start:start + BATCH_GET_LIMIT]]}}
+        attempt = 0
+        while request:
+            resp = call_with_retry(dynamodb_retry.batch_get_item, RequestItems=request, context=context)
+            for item in resp.get('Responses', {}).get(USERS_TABLE, []):
+                user = {k: v for k, v in item.items() if k not in PRIVATE_USER_FIELDS}
+                found[user['student_id']] = user
+                _user_cache[user['student_id']] = (now + USER_CACHE_TTL_SECONDS, user)
+                _user_cache.move_to_end(user['student_id'])
+            request = resp.get('UnprocessedKeys') or None
+            if request:
+                # Unprocessed keys mean the table is throttling us; back off before retrying them
+                attempt += 1
+                wait_before_retry(attempt, context, "unprocessed user keys")
+    
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return found
+
+def getUsers(event, context=None):
+    body = parse_body(event)
+    student_ids = body.get('student_ids') or (event.get('queryStringParameters') or {}).get('student_ids')
+    if isinstance(student_ids, str):
+        student_ids = [sid.strip() for sid in student_ids.split(',') if sid.strip()]
+    if not student_ids or not isinstance(student_ids, list):
+        return response(400, {"error": "missing student_ids"})
+    if len(student_ids) > MAX_BATCH_USER_IDS:
+        return response(400, {"error": f"at most {MAX_BATCH_USER_IDS} student_ids per request"})
+    try:
+        fields = parse_fields(event, body)
+    except ValueError as e:
+        return response(400, {"error": str(e)})
+    
+    student_ids = [str(sid) for sid in student_ids]
+    try:
+        found = fetch_users(student_ids, context)
+    except ThrottledError:
+        # Let the handler answer 429 with Retry-After
+        raise
+    except Exception as e:
+        print(f"Error getting users: {e}")
+        return response(500, {"error": str(e)})
+    # Always keep student_id so callers can map users back to their roster
+    keep = ['student_id', *fields] if fields else None
+    users = [trim_item(found[sid], keep) for sid in dict.fromkeys(student_ids) if sid in found]
+    not_found = [sid for sid in dict.fromkeys(student_ids) if sid not in found]
+    return response(200, {"users": users, "not_found": not_found})
 
 # -------------------------
 # 2.5) Verify Cognito Token
@@ -191,7 +539,9 @@ def getSessionByUUID(event, context=None):
             KeyConditionExpression=Key('beacon_uuid').eq(beacon),
             FilterExpression=Attr('status').eq('active')
         )
-    except Exception:
+    except Exception as e:
+        # Only fall back to a full scan when the index is missing, never under throttling
+        raise_if_throttled(e)
         resp = sessions_table.scan(
             FilterExpression=Attr('beacon_uuid').eq(beacon) & Attr('status').eq('active')
         )
@@ -279,7 +629,7 @@ def exportToS3(event, context=None):
             return response(400, {"error": "invalid export_type. Use 'attendance' or 'sessions'"})
         
         # Convert DynamoDB items to JSON
-        json_data = json.dumps(data, indent=2, default=str)
+        json_data = json.dumps(data, indent=2, default=json_default)
         
         # Upload to S3
         s3.put_object(
@@ -341,7 +691,7 @@ def logToCloudWatch(event, context=None):
             logEvents=[
                 {
                     'timestamp': int(datetime.now().timestamp() * 1000),
-                    'message': json.dumps(log_entry)
+                    'message': dumps(log_entry)
                 }
             ]
         )
@@ -357,13 +707,17 @@ def logToCloudWatch(event, context=None):
 # -------------------------
 def getAllSessions(event, context=None):
     try:
-        resp = sessions_table.scan()
+        fields = parse_fields(event, parse_body(event))
+    except ValueError as e:
+        return response(400, {"error": str(e)})
+    try:
+        resp = sessions_table.scan(**projection_kwargs(fields, 'created_at'))
         sessions = resp.get('Items', [])
         
         # Sort by created_at descending (newest first)
         sessions.sort(key=lambda x: x.get('created_at', ''), reverse=True)
         
-        return response(200, {"sessions": sessions})
+        return response(200, {"sessions": [trim_item(s, fields) for s in sessions]})
     except Exception as e:
         print(f"Error getting all sessions: {e}")
         return response(500, {"error": str(e)})
@@ -373,12 +727,18 @@ def getAllSessions(event, context=None):
 # -------------------------
 def getAllAttendance(event, context=None):
     try:
-        # Get all attendance records
-        resp = attendance_table.scan()
+        fields = parse_fields(event, parse_body(event))
+    except ValueError as e:
+        return response(400, {"error": str(e)})
+    try:
+        # Get all attendance records (session_id is needed for the join, timestamp for sorting)
+        resp = attendance_table.scan(**projection_kwargs(fields, 'session_id', 'timestamp'))
         attendance_records = resp.get('Items', [])
         
-        # Get all sessions to join class information
-        sessions_resp = sessions_table.scan()
+        # Get all sessions to join class information - only the joined columns are needed
+        sessions_resp = sessions_table.scan(**projection_kwargs(
+            ['session_id', 'class_id', 'class_name', 'room_id', 'start_time', 'teacher_id']
+        ))
         sessions = sessions_resp.get('Items', [])
         
         # Create session lookup dictionary
@@ -403,17 +763,19 @@ def getAllAttendance(event, context=None):
         # Sort by timestamp descending (newest first)
         enriched_records.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
         
-        return response(200, {"attendance": enriched_records})
+        return response(200, {"attendance": [trim_item(r, fields) for r in enriched_records]})
     except Exception as e:
         print(f"Error getting all attendance: {e}")
         return response(500, {"error": str(e)})
 
-def checkDuplicateAttendance(student_id, session_id):
+def checkDuplicateAttendance(student_id, session_id, context=None):
     # Check for duplicate attendance in the specific session only
     try:
         print(f"Checking for duplicate: student_id={student_id}, session_id={session_id}")
-        resp = attendance_table.scan(
-            FilterExpression=Attr('student_id').eq(student_id) & Attr('session_id').eq(session_id)
+        resp = call_with_retry(
+            retry_attendance_table.scan,
+            FilterExpression=Attr('student_id').eq(student_id) & Attr('session_id').eq(session_id),
+            context=context
         )
         items = resp.get('Items', [])
         print(f"Found {len(items)} matching records")
@@ -427,17 +789,20 @@ def checkDuplicateAttendance(student_id, session_id):
         print(f"NO DUPLICATE: student {student_id} not yet checked into session {session_id}")
         return False
     except Exception as e:
+        # Don't report "no duplicate" when we couldn't actually check
         print(f"Error checking duplicate attendance: {e}")
-        return False
+        raise
 
 # -------------------------
 # 7) Validate Beacon
 # -------------------------
-def validateBeacon(detected_uuid, rssi=None):
+def validateBeacon(detected_uuid, rssi=None, context=None):
     # Use scan to find active session with matching beacon_uuid
     try:
-        resp = sessions_table.scan(
-            FilterExpression=Attr('beacon_uuid').eq(detected_uuid) & Attr('status').eq('active')
+        resp = call_with_retry(
+            retry_sessions_table.scan,
+            FilterExpression=Attr('beacon_uuid').eq(detected_uuid) & Attr('status').eq('active'),
+            context=context
         )
         items = resp.get('Items', [])
         if not items:
@@ -470,9 +835,13 @@ def validateBeacon(detected_uuid, rssi=None):
                 return None, "session ended"
         
         return session, None
+    except ThrottledError:
+        # Busy, not invalid - let the handler answer 429 instead of rejecting the student
+        raise
     except Exception as e:
+        # A lookup failure is a server error, not a reason to reject the check-in
         print(f"Error validating beacon: {e}")
-        return None, "error validating beacon"
+        raise
 
 # -------------------------
 # 8) Mark Attendance
@@ -488,7 +857,7 @@ def markAttendance(event, context=None):
     if not student_id or not detected_uuid:
         return response(400, {"error": "missing student_id or detected_uuid/beacon_uuid"})
     
-    session, err = validateBeacon(detected_uuid, rssi)
+    session, err = validateBeacon(detected_uuid, rssi, context)
     if err:
         print(f"Beacon validation failed: {err}")
         return response(403, {"error": err})
@@ -502,20 +871,15 @@ def markAttendance(event, context=None):
         except:
             pass
     # Check for duplicate attendance in THIS specific session
-    duplicate_found = checkDuplicateAttendance(student_id, session_id)
+    duplicate_found = checkDuplicateAttendance(student_id, session_id, context)
     if duplicate_found:
         print(f"Duplicate attendance found for student {student_id} in session {session_id}")
         return response(200, {"message": "already checked-in", "student_id": student_id, "session_id": session_id})
     
     print(f"No duplicate found, proceeding with attendance for student {student_id} in session {session_id}")
     
-    # Get session information for response
-    try:
-        session_resp = sessions_table.get_item(Key={'session_id': session_id})
-        session_info = session_resp.get('Item', {})
-    except Exception as e:
-        print(f"Error fetching session info: {e}")
-        session_info = {}
+    # validateBeacon already returned the full session item, no need to read it again
+    session_info = session
     
     attendance_id = str(uuid.uuid4())
     
@@ -541,7 +905,7 @@ def markAttendance(event, context=None):
         'timestamp': now_iso(),
         'status': status
     }
-    attendance_table.put_item(Item=item)
+    call_with_retry(retry_attendance_table.put_item, Item=item, context=context)
     return response(200, {
         "message": "attendance recorded", 
         "record": item,
@@ -560,15 +924,37 @@ def getAttendanceBySession(event, context=None):
     session_id = params.get('session_id') or (event.get('queryStringParameters') or {}).get('session_id')
     if not session_id:
         return response(400, {"error": "missing session_id"})
+    try:
+        fields = parse_fields(event, params)
+    except ValueError as e:
+        return response(400, {"error": str(e)})
+    include_names = params.get('include_names') or (event.get('queryStringParameters') or {}).get('include_names')
+    include_names = include_names in (True, 'true', '1', 1)
+    required = ('student_id',) if include_names else ()
     try:
         resp = attendance_table.query(
             IndexName='session_id-index',
-            KeyConditionExpression=Key('session_id').eq(session_id)
+            KeyConditionExpression=Key('session_id').eq(session_id),
+            **projection_kwargs(fields, *required)
         )
         items = resp.get('Items', [])
-    except Exception:
-        resp = attendance_table.scan(FilterExpression=Attr('session_id').eq(session_id))
+    except Exception as e:
+        # Only fall back to a full scan when the index is missing, never under throttling
+        raise_if_throttled(e)
+        resp = attendance_table.scan(FilterExpression=Attr('session_id').eq(session_id), **projection_kwargs(fields, *required))
         items = resp.get('Items', [])
+    
+    if include_names and items:
+        # Embed student names so the roster doesn't need a getUser call per student
+        try:
+            users = fetch_users([item['student_id'] for item in items if item.get('student_id')], context)
+        except Exception as e:
+            print(f"Error fetching student names: {e}")
+            users = {}
+        for item in items:
+            item['student_name'] = users.get(item.get('student_id'), {}).get('name', '')
+        if fields:
+            items = [trim_item(item, [*fields, 'student_name']) for item in items]
     return response(200, {"attendance": items})
 
 # -------------------------
@@ -654,22 +1040,137 @@ def closeSession(event, context=None):
     except Exception as e:
         return response(500, {"error": str(e)})
 
+# -------------------------
+# 13) Idempotency Keys
+# -------------------------
+def get_idempotency_key(event, action):
+    key = get_header(event, 'Idempotency-Key') or event.get('idempotency_key')
+    if not key or action not in IDEMPOTENT_ACTIONS:
+        return None
+    # Scope by action so one key can't replay another action's response
+    return f"{action}:{str(key)[:255]}"
+
+def request_fingerprint(payload):
+    """Hash of the request payload, so a reused key with a different body can be rejected"""
+    payload = {k: v for k, v in payload.items() if k != 'idempotency_key'}
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=json_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def _cache_idempotent_result(key, expires_at, fingerprint, result):
+    _idempotency_cache[key] = (expires_at, fingerprint, result)
+    _idempotency_cache.move_to_end(key)
+    while len(_idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        _idempotency_cache.popitem(last=False)
+
+def _replay(result):
+    return {**result, 'headers': {**result.get('headers', {}), 'Idempotent-Replayed': 'true'}}
+
+def _key_reused_response():
+    return response(422, {"error": "Idempotency-Key was already used with a different request"})
+
+def _in_progress_response(retry_after=IDEMPOTENCY_RETRY_AFTER):
+    return retry_after_response(409, "a request with this Idempotency-Key is still in progress", retry_after)
+
+def _idempotency_unavailable_response(key, e):
+    # Fail closed: running the action without protection could duplicate its side effects
+    print(f"Error checking idempotency key {key}: {e}")
+    if isinstance(e, ThrottledError):
+        return throttled_response(e.retry_after)
+    return retry_after_response(503, "could not verify Idempotency-Key, please retry", IDEMPOTENCY_RETRY_AFTER)
+
+def cached_idempotent_response(key, fingerprint):
+    """Answer from the warm-container cache without touching DynamoDB, or return None"""
+    cached = _idempotency_cache.get(key)
+    if not cached:
+        return None
+    if cached[0] <= int(time.time()):
+        del _idempotency_cache[key]
+        return None
+    if cached[1] != fingerprint:
+        return _key_reused_response()
+    return _replay(cached[2])
+
+def begin_idempotent_request(key, fingerprint, context=None):
+    """
+    Claim an idempotency key before running the action.
+    Returns a response to send instead (replay, conflict or error), or None if
+    the caller should proceed.
+    """
+    cached = cached_idempotent_response(key, fingerprint)
+    if cached:
+        return cached
+    now = int(time.time())
+    
+    try:
+        # A retry costs this one read
+        item = call_with_retry(
+            idempotency_table.get_item,
+            Key={'idempotency_key': key},
+            ConsistentRead=True,
+            context=context
+        ).get('Item')
+    except Exception as e:
+        return _idempotency_unavailable_response(key, e)
+    if item and int(item.get('expires_at', 0)) > now:
+        if item.get('fingerprint') != fingerprint:
+            return _key_reused_response()
+        if item.get('state') != 'completed':
+            return _in_progress_response(max(1, min(int(item['expires_at']) - now, IDEMPOTENCY_RETRY_AFTER)))
+        result = {
+            'statusCode': int(item['status_code']),
+            'headers': {**CORS_HEADERS, 'Content-Type': 'application/json'},
+            'body': item['body']
+        }
+        _cache_idempotent_result(key, int(item['expires_at']), fingerprint, result)
+        return _replay(result)
+    
+    try:
+        # Claim the key so a concurrent retry can't run the action a second time
+        call_with_retry(
+            idempotency_table.put_item,
+            Item={
+                'idempotency_key': key,
+                'state': 'in_progress',
+                'fingerprint': fingerprint,
+                'expires_at': now + IDEMPOTENCY_LOCK_SECONDS
+            },
+            ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+            ExpressionAttributeValues={':now': now},
+            context=context
+        )
+    except dynamodb_retry.meta.client.exceptions.ConditionalCheckFailedException:
+        return _in_progress_response()
+    except Exception as e:
+        return _idempotency_unavailable_response(key, e)
+    return None
+
+def finish_idempotent_request(key, fingerprint, result, context=None):
+    """Store the first successful response for replay, or release the key so the client can retry"""
+    try:
+        if not 200 <= result.get('statusCode', 500) < 300:
+            call_with_retry(idempotency_table.delete_item, Key={'idempotency_key': key}, context=context)
+            return
+        expires_at = int(time.time()) + IDEMPOTENCY_TTL_SECONDS
+        call_with_retry(idempotency_table.put_item, Item={
+            'idempotency_key': key,
+            'state': 'completed',
+            'fingerprint': fingerprint,
+            'status_code': result['statusCode'],
+            'body': result['body'],
+            'expires_at': expires_at
+        }, context=context)
+        _cache_idempotent_result(key, expires_at, fingerprint, result)
+    except Exception as e:
+        # The action already ran; the in-progress claim still blocks duplicates until it expires
+        print(f"Error storing idempotency key {key}: {e}")
+
 # -------------------------
 # Lambda handler
 # -------------------------
 def lambda_handler(event, context):
     # Handle CORS preflight requests
     if event.get('httpMethod') == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({})
-        }
+        return response(200, {})
     
     # Handle API Gateway proxy integration format
     if 'body' in event and event['body']:
@@ -685,6 +1186,7 @@ def lambda_handler(event, context):
             
             # Create a new event with body data merged into event
             proxy_event = {**event, **body_data}
+            payload = body_data
             
         except (json.JSONDecodeError, TypeError):
             return response(400, {"error": "invalid JSON in request body"})
@@ -692,26 +1194,36 @@ def lambda_handler(event, context):
         # Direct Lambda invocation (non-proxy)
         action = event.get('action')
         proxy_event = event
+        payload = event
     
     if not action:
         return response(400, {"error": "missing action"})
     
-    # Add CORS headers for browser requests
-    cors_response = lambda status, body: {
-        'statusCode': status,
-        'headers': {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
-        },
-        'body': json.dumps(body or {})
-    }
+    idempotency_key = get_idempotency_key(proxy_event, action)
+    if idempotency_key:
+        fingerprint = request_fingerprint(payload)
+        # A warm-cache replay costs nothing, so answer it even while shedding load
+        replayed = cached_idempotent_response(idempotency_key, fingerprint)
+        if replayed:
+            return compress_response(replayed, event)
+    
+    # Under sustained throttling, fail fast so clients back off instead of piling on
+    if action in SHEDDABLE_ACTIONS and should_shed_load():
+        print(f"Shedding {action}: {len(_recent_throttles)} throttles in the last {SHED_WINDOW_SECONDS}s")
+        return throttled_response(random.randint(1, SHED_RETRY_AFTER_MAX))
+    
+    if idempotency_key:
+        replayed = begin_idempotent_request(idempotency_key, fingerprint, context)
+        if replayed:
+            return compress_response(replayed, event)
     
     try:
         if action == 'createUser':
             result = createUser(proxy_event, context)
         elif action == 'getUser':
             result = getUser(proxy_event, context)
+        elif action == 'getUsers':
+            result = getUsers(proxy_event, context)
         elif action == 'verifyToken':
             result = verifyToken(proxy_event, context)
         elif action == 'createSession':
@@ -739,21 +1251,22 @@ def lambda_handler(event, context):
         elif action == 'logToCloudWatch':
             result = logToCloudWatch(proxy_event, context)
         else:
-            return cors_response(400, {"error": f"unknown action {action}"})
-        
-        # Convert response format for API Gateway
-        if isinstance(result, dict) and 'statusCode' in result:
-            return {
-                'statusCode': result['statusCode'],
-                'headers': {
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                    'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
-                },
-                'body': result['body']
-            }
-        else:
-            return cors_response(200, result)
-            
+            return response(400, {"error": f"unknown action {action}"})
+        
+        # Handlers already return a serialized API Gateway response; only wrap raw results
+        if not (isinstance(result, dict) and 'statusCode' in result):
+            result = response(200, result)
+        if idempotency_key:
+            finish_idempotent_request(idempotency_key, fingerprint, result, context)
+        return compress_response(result, event)
+    
+    except ThrottledError as e:
+        result = throttled_response(e.retry_after)
+        if idempotency_key:
+            finish_idempotent_request(idempotency_key, fingerprint, result, context)
+        return result
     except Exception as e:
-        return cors_response(500, {"error": f"internal server error: {str(e)}"})
+        result = response(500, {"error": f"internal server error: {str(e)}"})
+        if idempotency_key:
+            finish_idempotent_request(idempotency_key, fingerprint, result, context)
+        return result